@@ -1,19 +1,117 @@
 import argparse
+import contextlib
 import numpy as np
+import os
 import pickle
 import time
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel as DDP
 
-import model.non_linear.thp.transformer.Constants as Constants
 from model.non_linear.thp import Utils
 
-from model.non_linear.thp.preprocess.Dataset import get_dataloader
-from model.non_linear.thp.transformer.Models import Transformer
+from model.non_linear.thp.preprocess.Dataset import DataPrefetcher, MemmapEventData, event_arrays_current, \
+    get_dataloader, save_event_arrays
+from model.non_linear.thp.transformer.Models import Transformer, get_non_pad_mask
 from tqdm import tqdm
 
 
+def setup_distributed(opt):
+    """ Initialize the process group when launched by torchrun, one process per GPU. """
+
+    opt.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if not opt.distributed:
+        opt.rank = 0
+        opt.local_rank = 0
+        return
+
+    dist.init_process_group(backend='nccl' if opt.device.type == 'cuda' else 'gloo')
+    opt.rank = dist.get_rank()
+    opt.local_rank = int(os.environ['LOCAL_RANK'])
+    if opt.device.type == 'cuda':
+        torch.cuda.set_device(opt.local_rank)
+        opt.device = torch.device('cuda', opt.local_rank)
+
+
+def is_main_process(opt):
+    """ Only rank 0 prints and writes logs. """
+
+    return getattr(opt, 'rank', 0) == 0
+
+
+def unwrap_model(model):
+    """ Return the underlying Transformer, whose heads are used by the loss helpers. """
+
+    model = model.module if isinstance(model, DDP) else model
+    # torch.compile keeps the original module in _orig_mod
+    return getattr(model, '_orig_mod', model)
+
+
+_compiled_losses = {}
+
+
+def compiled(loss_fn, opt):
+    """ With opt.compile, fuse the likelihood, type and time losses of a batch into one compiled graph. """
+
+    if not getattr(opt, 'compile', False):
+        return loss_fn
+    if loss_fn not in _compiled_losses:
+        _compiled_losses[loss_fn] = torch.compile(loss_fn, dynamic=True)
+    return _compiled_losses[loss_fn]
+
+
+def set_epoch(data_loader, epoch):
+    """ Reshuffle the per-rank shards of a distributed or bucketed sampler every epoch. """
+
+    for sampler in (getattr(data_loader, 'sampler', None), getattr(data_loader, 'batch_sampler', None)):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+
+def progress(data, desc, opt):
+    """ Progress bar on rank 0 only, refreshed rarely so that it stays off the training hot path. """
+
+    return tqdm(data, mininterval=10, miniters=50, desc=desc, leave=False,
+                disable=not is_main_process(opt) or getattr(opt, 'quiet', False))
+
+
+def autocast(opt):
+    """ Mixed-precision context for forward and loss, selected by opt.amp ('bf16', 'fp16' or None). """
+
+    amp = getattr(opt, 'amp', None)
+    dtype = torch.float16 if amp == 'fp16' else torch.bfloat16
+    return torch.autocast(device_type=opt.device.type, dtype=dtype, enabled=amp is not None)
+
+
+def grad_scaler(opt):
+    """ Loss scaling is only needed for FP16; BF16 has the dynamic range of FP32. """
+
+    enabled = getattr(opt, 'amp', None) == 'fp16'
+    # torch.amp.GradScaler is only available from torch 2.3 on
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(opt.device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def gradient_sync(model, sync):
+    """ Skip the DDP AllReduce on micro-batches that only accumulate gradients. """
+
+    if isinstance(model, DDP) and not sync:
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def reduce_totals(totals, opt):
+    """ Sum the on-device epoch accumulators across ranks and copy them to the host in one sync. """
+
+    totals = torch.stack(totals)
+    if getattr(opt, 'distributed', False):
+        dist.all_reduce(totals)
+    return totals.tolist()
+
+
 def prepare_dataloader(opt):
     """ Load real_data and prepare dataloader. """
 
@@ -24,65 +122,96 @@ def prepare_dataloader(opt):
             data = data[dict_name]
             return data, int(num_types)
 
-    print('[Info] Loading train real_data...')
-    train_data, num_types = load_data(opt.data + 'train.pkl', 'train')
-    print('[Info] Loading dev real_data...')
-    dev_data, _ = load_data(opt.data + 'dev.pkl', 'dev')
-    print('[Info] Loading test real_data...')
-    test_data, _ = load_data(opt.data + 'test.pkl', 'test')
-
-    trainloader = get_dataloader(train_data, opt.batch_size, shuffle=True)
-    testloader = get_dataloader(test_data, opt.batch_size, shuffle=False)
+    def load_memmap(name, dict_name):
+        # convert the pickle once (again whenever it changes), later runs page in only the streams that are read
+        prefix = opt.data + dict_name
+        if is_main_process(opt) and not event_arrays_current(prefix, name):
+            data, num_types = load_data(name, dict_name)
+            save_event_arrays(data, num_types, prefix, source=name)
+        if getattr(opt, 'distributed', False):
+            dist.barrier()
+        return MemmapEventData(prefix), int(np.load(prefix + '.dim_process.npy'))
+
+    load = load_memmap if getattr(opt, 'mmap', False) else load_data
+
+    if is_main_process(opt):
+        print('[Info] Loading train real_data...')
+    train_data, num_types = load(opt.data + 'train.pkl', 'train')
+    if is_main_process(opt):
+        print('[Info] Loading dev real_data...')
+    dev_data, _ = load(opt.data + 'dev.pkl', 'dev')
+    if is_main_process(opt):
+        print('[Info] Loading test real_data...')
+    test_data, _ = load(opt.data + 'test.pkl', 'test')
+
+    num_workers = getattr(opt, 'num_workers', None)
+    trainloader = get_dataloader(train_data, opt.batch_size, shuffle=True,
+                                 distributed=getattr(opt, 'distributed', False), num_workers=num_workers,
+                                 bucket=getattr(opt, 'bucket', False))
+    testloader = get_dataloader(test_data, opt.batch_size, shuffle=False, num_workers=num_workers)
     return trainloader, testloader, num_types
 
 
-def train_epoch(model, training_data, optimizer, pred_loss_func, opt):
+def train_epoch(model, training_data, optimizer, pred_loss_func, opt, scaler=None):
     """ Epoch operation in training phase. """
 
     model.train()
-
-    total_event_ll = 0  # cumulative event log-likelihood
-    total_time_se = 0  # cumulative time prediction squared-error
-    total_event_rate = 0  # cumulative number of correct prediction
-    total_num_event = 0  # number of total events
-    total_num_pred = 0  # number of predictions
-    for batch in tqdm(training_data, mininterval=2,
-                      desc='  - (Training)   ', leave=False):
-        """ prepare real_data """
-        event_time, time_gap, event_type = map(lambda x: x.to(opt.device), batch)
+    if scaler is None:
+        scaler = grad_scaler(opt)
+    compute_loss = compiled(Utils.compute_loss, opt)
+
+    # accumulators stay on the device so that note keeping does not sync every step
+    total_event_ll = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative event log-likelihood
+    total_time_se = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative time prediction squared-error
+    total_event_rate = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative number of correct prediction
+    total_num_event = torch.zeros((), dtype=torch.float64, device=opt.device)  # number of total events
+    total_num_pred = torch.zeros((), dtype=torch.float64, device=opt.device)  # number of predictions
+
+    # gradients of accum_steps micro-batches are summed before each optimizer step
+    accum_steps = getattr(opt, 'accum_steps', 1)
+    num_batches = len(training_data)
+    optimizer.zero_grad(set_to_none=True)
+    for step, batch in enumerate(progress(DataPrefetcher(training_data, opt.device), '  - (Training)   ', opt)):
+        """ prepare real_data, already copied to the device by the prefetcher """
+        event_time, time_gap, event_type = batch
+        # shared by the model, the likelihood and the event counts
+        non_pad_mask = get_non_pad_mask(event_type)
+        update = (step + 1) % accum_steps == 0 or step + 1 == num_batches
+        # the last group of the epoch may hold fewer than accum_steps micro-batches
+        group_size = min(accum_steps, num_batches - step // accum_steps * accum_steps)
 
         """ forward """
-        optimizer.zero_grad()
-
-        enc_out, prediction = model(event_type, event_time)
+        with gradient_sync(model, update):
+            with autocast(opt):
+                enc_out, prediction = model(event_type, event_time, non_pad_mask)
 
-        """ backward """
-        # negative log-likelihood
-        event_ll, non_event_ll = Utils.log_likelihood(model, enc_out, event_time, event_type)
-        event_loss = -torch.sum(event_ll - non_event_ll)
+                """ backward """
+                event_loss, pred_loss, se, pred_num_event = compute_loss(
+                    unwrap_model(model), enc_out, prediction, event_time, event_type, pred_loss_func,
+                    non_pad_mask.squeeze(2))
 
-        # type prediction
-        pred_loss, pred_num_event = Utils.type_loss(prediction[0], event_type, pred_loss_func)
-
-        # time prediction
-        se = Utils.time_loss(prediction[1], event_time)
-
-        # SE is usually large, scale it to stabilize training
-        scale_time_loss = 100
-        loss = event_loss + pred_loss + se / scale_time_loss
-        loss.backward()
+                # SE is usually large, scale it to stabilize training
+                scale_time_loss = 100
+                loss = (event_loss + pred_loss + se / scale_time_loss) / group_size
+            scaler.scale(loss).backward()
 
         """ update parameters """
-        optimizer.step()
+        if update:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
         """ note keeping """
-        total_event_ll += -event_loss.item()
-        total_time_se += se.item()
-        total_event_rate += pred_num_event.item()
-        total_num_event += event_type.ne(Constants.PAD).sum().item()
+        num_event = non_pad_mask.sum()
+        total_event_ll += -event_loss.detach()
+        total_time_se += se.detach()
+        total_event_rate += pred_num_event
+        total_num_event += num_event
         # we do not predict_rmtpp the first event
-        total_num_pred += event_type.ne(Constants.PAD).sum().item() - event_time.shape[0]
+        total_num_pred += num_event - event_time.shape[0]
 
+    total_event_ll, total_time_se, total_event_rate, total_num_event, total_num_pred = reduce_totals(
+        [total_event_ll, total_time_se, total_event_rate, total_num_event, total_num_pred], opt)
     rmse = np.sqrt(total_time_se / total_num_pred)
     return total_event_ll / total_num_event, total_event_rate / total_num_pred, rmse
 
@@ -90,72 +219,88 @@ def train_epoch(model, training_data, optimizer, pred_loss_func, opt):
 # train with exogenous messages
 def train_with_exo_mae(model, training_data, optimizer, scheduler, pred_loss_func, opt):
     """ Start training. """
+    scaler = grad_scaler(opt)
     for epoch_i in range(opt.epoch):
         epoch = epoch_i + 1
-        print('[ Epoch', epoch, ']')
+        set_epoch(training_data, epoch)
+        if is_main_process(opt):
+            print('[ Epoch', epoch, ']')
 
         start = time.time()
         likelihood, mark_error, time_error = train_epoch_with_exo_mae(model, training_data, optimizer, pred_loss_func,
-                                                                      opt)
-        print('  - (Training)    loglikelihood: {likelihood: 8.5f}, '
-              'mark error: {mark_error: 8.5f}, time error: {time_error: 8.5f}, '
-              'elapse: {elapse:3.3f} min'
-              .format(likelihood=likelihood, mark_error=mark_error, time_error=time_error,
-                      elapse=(time.time() - start) / 60))
+                                                                      opt, scaler)
+        if is_main_process(opt):
+            print('  - (Training)    loglikelihood: {likelihood: 8.5f}, '
+                  'mark error: {mark_error: 8.5f}, time error: {time_error: 8.5f}, '
+                  'elapse: {elapse:3.3f} min'
+                  .format(likelihood=likelihood, mark_error=mark_error, time_error=time_error,
+                          elapse=(time.time() - start) / 60))
         scheduler.step()
 
 
 # endo_mask_out in training_data
-def train_epoch_with_exo_mae(model, training_data, optimizer, pred_loss_func, opt):
+def train_epoch_with_exo_mae(model, training_data, optimizer, pred_loss_func, opt, scaler=None):
     model.train()
-
-    total_event_ll = 0  # cumulative event log-likelihood
-    total_time_se = 0  # cumulative time prediction squared-error
-    total_time_ae = 0  # absolute error
-    total_event_rate = 0  # cumulative number of correct prediction
-    total_num_event = 0  # number of total events
-    total_num_pred = 0  # number of predictions
-    for batch in tqdm(training_data, mininterval=2,
-                      desc='  - (Training)   ', leave=False):
-        """ prepare real_data """
-        event_time, time_gap, event_type, endo_mask = map(lambda x: x.to(opt.device), batch)
+    if scaler is None:
+        scaler = grad_scaler(opt)
+    compute_loss = compiled(Utils.compute_loss_exo, opt)
+
+    # accumulators stay on the device so that note keeping does not sync every step
+    total_event_ll = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative event log-likelihood
+    total_time_se = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative time prediction squared-error
+    total_time_ae = torch.zeros((), dtype=torch.float64, device=opt.device)  # absolute error
+    total_event_rate = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative number of correct prediction
+    total_num_event = torch.zeros((), dtype=torch.float64, device=opt.device)  # number of total events
+    total_num_pred = torch.zeros((), dtype=torch.float64, device=opt.device)  # number of predictions
+
+    # gradients of accum_steps micro-batches are summed before each optimizer step
+    accum_steps = getattr(opt, 'accum_steps', 1)
+    num_batches = len(training_data)
+    optimizer.zero_grad(set_to_none=True)
+    for step, batch in enumerate(progress(DataPrefetcher(training_data, opt.device), '  - (Training)   ', opt)):
+        """ prepare real_data, already copied to the device by the prefetcher """
+        event_time, time_gap, event_type, endo_mask = batch
+        # shared by the model, the likelihood and the event counts
+        non_pad_mask = get_non_pad_mask(event_type)
+        update = (step + 1) % accum_steps == 0 or step + 1 == num_batches
+        # the last group of the epoch may hold fewer than accum_steps micro-batches
+        group_size = min(accum_steps, num_batches - step // accum_steps * accum_steps)
 
         """ forward """
-        optimizer.zero_grad()
-
-        enc_out, prediction = model(event_type, event_time)
+        with gradient_sync(model, update):
+            with autocast(opt):
+                enc_out, prediction = model(event_type, event_time, non_pad_mask)
 
-        """ backward """
-        # negative log-likelihood
-        event_ll, non_event_ll = Utils.log_likelihood_exo(model, enc_out, event_time, event_type, endo_mask)
-        event_loss = -torch.sum(event_ll - non_event_ll)
+                """ backward """
+                event_loss, pred_loss, se, ae, pred_num_event = compute_loss(
+                    unwrap_model(model), enc_out, prediction, event_time, event_type, pred_loss_func, endo_mask,
+                    non_pad_mask.squeeze(2))
 
-        # type prediction
-        pred_loss, pred_num_event = Utils.type_loss_exo(prediction[0], event_type, pred_loss_func, endo_mask)
-
-        # time prediction
-        se = Utils.time_loss_exo(prediction[1], event_time, endo_mask)
-
-        # SE is usually large, scale it to stabilize training
-        scale_time_loss = 100
-        loss = event_loss + pred_loss + se / scale_time_loss
-        loss.backward()
+                # SE is usually large, scale it to stabilize training
+                scale_time_loss = 100
+                loss = (event_loss + pred_loss + se / scale_time_loss) / group_size
+            scaler.scale(loss).backward()
 
         """ update parameters """
-        optimizer.step()
+        if update:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
         """ note keeping """
-        total_event_ll += -event_loss.item()
+        num_event = non_pad_mask.sum()
+        total_event_ll += -event_loss.detach()
         """ se           """
-        total_time_se += se.item()
+        total_time_se += se.detach()
         """ ae           """
-        ae = Utils.time_loss_ae(prediction[1], event_time)
-        total_time_ae += ae.item()
-        total_event_rate += pred_num_event.item()
-        total_num_event += event_type.ne(Constants.PAD).sum().item()
+        total_time_ae += ae
+        total_event_rate += pred_num_event
+        total_num_event += num_event
         # we do not predict_rmtpp the first event
-        total_num_pred += event_type.ne(Constants.PAD).sum().item() - event_time.shape[0]
+        total_num_pred += num_event - event_time.shape[0]
 
+    total_event_ll, total_time_ae, total_event_rate, total_num_event, total_num_pred = reduce_totals(
+        [total_event_ll, total_time_ae, total_event_rate, total_num_event, total_num_pred], opt)
     mae = total_time_ae / total_num_pred
     # likelihood, mark_error, time_error
     return total_event_ll / total_num_event, 1 - (total_event_rate / total_num_pred), mae
@@ -166,81 +311,247 @@ def train(model, training_data, validation_data, optimizer, scheduler, pred_loss
     valid_event_losses = []  # validation log-likelihood
     valid_pred_losses = []  # validation event type prediction accuracy
     valid_rmse = []  # validation event time prediction RMSE
+    scaler = grad_scaler(opt)
     for epoch_i in range(opt.epoch):
         epoch = epoch_i + 1
-        print('[ Epoch', epoch, ']')
+        set_epoch(training_data, epoch)
+        if is_main_process(opt):
+            print('[ Epoch', epoch, ']')
 
         start = time.time()
-        train_event, train_type, train_time = train_epoch(model, training_data, optimizer, pred_loss_func, opt)
-        print('  - (Training)    loglikelihood: {ll: 8.5f}, '
-              'accuracy: {type: 8.5f}, RMSE: {rmse: 8.5f}, '
-              'elapse: {elapse:3.3f} min'
-              .format(ll=train_event, type=train_type, rmse=train_time, elapse=(time.time() - start) / 60))
+        train_event, train_type, train_time = train_epoch(model, training_data, optimizer, pred_loss_func, opt,
+                                                          scaler)
+        if is_main_process(opt):
+            print('  - (Training)    loglikelihood: {ll: 8.5f}, '
+                  'accuracy: {type: 8.5f}, RMSE: {rmse: 8.5f}, '
+                  'elapse: {elapse:3.3f} min'
+                  .format(ll=train_event, type=train_type, rmse=train_time, elapse=(time.time() - start) / 60))
 
         start = time.time()
         valid_event, valid_type, valid_time = eval_epoch(model, validation_data, pred_loss_func, opt)
-        print('  - (Testing)     loglikelihood: {ll: 8.5f}, '
-              'accuracy: {type: 8.5f}, RMSE: {rmse: 8.5f}, '
-              'elapse: {elapse:3.3f} min'
-              .format(ll=valid_event, type=valid_type, rmse=valid_time, elapse=(time.time() - start) / 60))
+        if is_main_process(opt):
+            print('  - (Testing)     loglikelihood: {ll: 8.5f}, '
+                  'accuracy: {type: 8.5f}, RMSE: {rmse: 8.5f}, '
+                  'elapse: {elapse:3.3f} min'
+                  .format(ll=valid_event, type=valid_type, rmse=valid_time, elapse=(time.time() - start) / 60))
 
         valid_event_losses += [valid_event]
         valid_pred_losses += [valid_type]
         valid_rmse += [valid_time]
-        print('  - [Info] Maximum ll: {event: 8.5f}, '
-              'Maximum accuracy: {pred: 8.5f}, Minimum RMSE: {rmse: 8.5f}'
-              .format(event=max(valid_event_losses), pred=max(valid_pred_losses), rmse=min(valid_rmse)))
+        if is_main_process(opt):
+            print('  - [Info] Maximum ll: {event: 8.5f}, '
+                  'Maximum accuracy: {pred: 8.5f}, Minimum RMSE: {rmse: 8.5f}'
+                  .format(event=max(valid_event_losses), pred=max(valid_pred_losses), rmse=min(valid_rmse)))
 
-        # logging
-        with open(opt.log, 'a') as f:
-            f.write('{epoch}, {ll: 8.5f}, {acc: 8.5f}, {rmse: 8.5f}\n'
-                    .format(epoch=epoch, ll=valid_event, acc=valid_type, rmse=valid_time))
+            # logging
+            with open(opt.log, 'a') as f:
+                f.write('{epoch}, {ll: 8.5f}, {acc: 8.5f}, {rmse: 8.5f}\n'
+                        .format(epoch=epoch, ll=valid_event, acc=valid_type, rmse=valid_time))
 
         scheduler.step()
 
 
-def eval_epoch_mae(model, validation_data, pred_loss_func, opt):
+def eval_epoch(model, validation_data, pred_loss_func, opt):
     """ Epoch operation in evaluation phase. """
 
+    model.eval()
+
+    # accumulators stay on the device so that note keeping does not sync every step
+    total_event_ll = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative event log-likelihood
+    total_time_se = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative time prediction squared-error
+    total_event_rate = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative number of correct prediction
+    total_num_event = torch.zeros((), dtype=torch.float64, device=opt.device)  # number of total events
+    total_num_pred = torch.zeros((), dtype=torch.float64, device=opt.device)  # number of predictions
+    with torch.no_grad():
+        for batch in progress(validation_data, '  - (Validation) ', opt):
+            """ prepare real_data """
+            event_time, time_gap, event_type = map(lambda x: x.to(opt.device), batch)
+            # shared by the model, the likelihood and the event counts
+            non_pad_mask = get_non_pad_mask(event_type)
+
+            """ forward """
+            enc_out, prediction = model(event_type, event_time, non_pad_mask)
+
+            """ compute loss """
+            event_loss, _, se, pred_num = Utils.compute_loss(
+                unwrap_model(model), enc_out, prediction, event_time, event_type, pred_loss_func,
+                non_pad_mask.squeeze(2))
+
+            """ note keeping """
+            num_event = non_pad_mask.sum()
+            total_event_ll += -event_loss
+            total_time_se += se
+            total_event_rate += pred_num
+            total_num_event += num_event
+            total_num_pred += num_event - event_time.shape[0]
+
+    # every rank evaluates the full set, so there is nothing to all_reduce
+    total_event_ll, total_time_se, total_event_rate, total_num_event, total_num_pred = torch.stack(
+        [total_event_ll, total_time_se, total_event_rate, total_num_event, total_num_pred]).tolist()
+    rmse = np.sqrt(total_time_se / total_num_pred)
+    return total_event_ll / total_num_event, total_event_rate / total_num_pred, rmse
+
+
+def eval_epoch_mae(model, validation_data, pred_loss_func, opt):
+    """
+    Epoch operation in evaluation phase, on batches of get_masked_dataloader.
+    Partial batches are not evaluated: build the loader with drop_last=True.
+    """
+
     pred_event, true_event, pred_time, true_time = [], [], [], []
 
     model.eval()
 
-    total_event_ll = 0  # cumulative event log-likelihood
-    total_time_ae = 0  # absolute error
-    total_event_rate = 0  # cumulative number of correct prediction
-    total_num_event = 0  # number of total events
-    total_num_pred = 0  # number of predictions
+    # accumulators stay on the device so that note keeping does not sync every step
+    total_event_ll = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative event log-likelihood
+    total_time_ae = torch.zeros((), dtype=torch.float64, device=opt.device)  # absolute error
+    total_event_rate = torch.zeros((), dtype=torch.float64, device=opt.device)  # cumulative number of correct prediction
+    total_num_event = torch.zeros((), dtype=torch.float64, device=opt.device)  # number of total events
+    total_num_pred = torch.zeros((), dtype=torch.float64, device=opt.device)  # number of predictions
     with torch.no_grad():
-        for batch in tqdm(validation_data, mininterval=2,
-                          desc='  - (Validation) ', leave=False):
-            if batch[0].size(0) < opt.batch_size:
-                continue
+        for batch in progress(validation_data, '  - (Validation) ', opt):
             """ prepare real_data """
             event_time, time_gap, event_type, _ = map(lambda x: x.to(opt.device), batch)
+            # shared by the model, the likelihood and the event counts
+            non_pad_mask = get_non_pad_mask(event_type)
 
             """ forward """
-            enc_out, prediction = model(event_type, event_time)
+            enc_out, prediction = model(event_type, event_time, non_pad_mask)
 
             """ compute loss """
-            event_ll, non_event_ll = Utils.log_likelihood(model, enc_out, event_time, event_type)
+            event_ll, non_event_ll = Utils.log_likelihood(unwrap_model(model), enc_out, event_time, event_type,
+                                                          non_pad_mask.squeeze(2))
             event_loss = -torch.sum(event_ll - non_event_ll)
             _, pred_num = Utils.type_loss(prediction[0], event_type, pred_loss_func)
             ae = Utils.time_loss_ae(prediction[1], event_time)
 
             """ note keeping """
-            total_event_ll += -event_loss.item()
-            total_time_ae += ae.item()
-            total_event_rate += pred_num.item()
-            total_num_event += event_type.ne(Constants.PAD).sum().item()
-            total_num_pred += event_type.ne(Constants.PAD).sum().item() - event_time.shape[0]
-
-            pred_event += [prediction[0][:, :-1, :]]
-            true_event += [event_type[:, 1:] - 1]
-            pred_time += [prediction[1][:, :-1]]
-            true_time += [event_time[:, 1:] - event_time[:, :-1]]
-
+            num_event = non_pad_mask.sum()
+            total_event_ll += -event_loss
+            total_time_ae += ae
+            total_event_rate += pred_num
+            total_num_event += num_event
+            total_num_pred += num_event - event_time.shape[0]
+
+            # keep the collected outputs in host memory, so they do not pin device memory for the whole pass
+            pred_event.append(prediction[0][:, :-1, :].cpu())
+            true_event.append((event_type[:, 1:] - 1).cpu())
+            pred_time.append(prediction[1][:, :-1].cpu())
+            true_time.append((event_time[:, 1:] - event_time[:, :-1]).cpu())
+
+    # every rank evaluates the full set, so there is nothing to all_reduce
+    total_event_ll, total_time_ae, total_event_rate, total_num_event, total_num_pred = torch.stack(
+        [total_event_ll, total_time_ae, total_event_rate, total_num_event, total_num_pred]).tolist()
     mae = total_time_ae / total_num_pred
 
     return pred_event, true_event, pred_time, true_time, \
            total_event_ll / total_num_event, 1 - (total_event_rate / total_num_pred), mae
+
+
+def main():
+    """ Main function. """
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-data', required=True)
+
+    parser.add_argument('-epoch', type=int, default=30)
+    parser.add_argument('-batch_size', type=int, default=16)
+
+    parser.add_argument('-d_model', type=int, default=64)
+    parser.add_argument('-d_rnn', type=int, default=256)
+    parser.add_argument('-d_inner_hid', type=int, default=128)
+    parser.add_argument('-d_k', type=int, default=16)
+    parser.add_argument('-d_v', type=int, default=16)
+
+    parser.add_argument('-n_head', type=int, default=4)
+    parser.add_argument('-n_layers', type=int, default=4)
+
+    parser.add_argument('-dropout', type=float, default=0.1)
+    parser.add_argument('-lr', type=float, default=1e-4)
+    parser.add_argument('-smooth', type=float, default=0.1)
+
+    parser.add_argument('-log', type=str, default='log.txt')
+    parser.add_argument('-quiet', action='store_true', help='disable the progress bars')
+    # dataloader workers, defaults to half the CPU cores (at most 8); 0 loads in the main process
+    parser.add_argument('-num_workers', type=int, default=None)
+    # read the event streams from memory-mapped .npy files converted from the pickles on first use
+    parser.add_argument('-mmap', action='store_true')
+    # batch training streams of similar length together to reduce padding
+    parser.add_argument('-bucket', action='store_true')
+
+    # mixed precision for forward and loss; fp16 additionally enables loss scaling
+    parser.add_argument('-amp', type=str, default=None, choices=['bf16', 'fp16'])
+    parser.add_argument('-compile', action='store_true')
+    # micro-batches per optimizer step, the effective batch size is batch_size * accum_steps
+    parser.add_argument('-accum_steps', type=int, default=1)
+    # trade recomputation in backward for activation memory of the encoder layers
+    parser.add_argument('-grad_checkpoint', action='store_true')
+
+    opt = parser.parse_args()
+
+    # default device is CUDA when available; under torchrun each process is pinned to its local GPU
+    opt.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    setup_distributed(opt)
+
+    # autotune cuDNN kernels and run FP32 matmuls on TF32 tensor cores (Ampere and newer)
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
+    # setup the log file
+    if is_main_process(opt):
+        with open(opt.log, 'w') as f:
+            f.write('Epoch, Log-likelihood, Accuracy, RMSE\n')
+
+    """ prepare dataloader """
+    trainloader, testloader, num_types = prepare_dataloader(opt)
+
+    """ prepare model """
+    model = Transformer(
+        num_types=num_types,
+        d_model=opt.d_model,
+        d_rnn=opt.d_rnn,
+        d_inner=opt.d_inner_hid,
+        n_layers=opt.n_layers,
+        n_head=opt.n_head,
+        d_k=opt.d_k,
+        d_v=opt.d_v,
+        dropout=opt.dropout,
+        grad_checkpoint=opt.grad_checkpoint,
+    )
+    model.to(opt.device)
+    if opt.compile:
+        # fuse the attention, LayerNorm and GELU chains; dynamic shapes follow the per-batch padding length
+        model = torch.compile(model, mode='max-autotune', fullgraph=False, dynamic=True)
+    if opt.distributed:
+        # default 25 MB buckets let the AllReduce of late layers overlap with backward of earlier ones
+        model = DDP(model, device_ids=[opt.local_rank] if opt.device.type == 'cuda' else None, bucket_cap_mb=25)
+
+    """ optimizer and scheduler """
+    # the fused CUDA kernel updates all parameters in one launch instead of one per tensor
+    optimizer = optim.Adam(filter(lambda x: x.requires_grad, model.parameters()),
+                           opt.lr, betas=(0.9, 0.999), eps=1e-05, fused=opt.device.type == 'cuda')
+    scheduler = optim.lr_scheduler.StepLR(optimizer, 10, gamma=0.5)
+
+    """ prediction loss function, either cross entropy or label smoothing """
+    if opt.smooth > 0:
+        pred_loss_func = Utils.LabelSmoothingLoss(opt.smooth, num_types, ignore_index=-1)
+    else:
+        pred_loss_func = nn.CrossEntropyLoss(ignore_index=-1, reduction='none')
+
+    """ number of parameters """
+    num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    if is_main_process(opt):
+        print('[Info] Number of parameters: {}'.format(num_params))
+
+    """ train the model """
+    train(model, trainloader, testloader, optimizer, scheduler, pred_loss_func, opt)
+
+    if opt.distributed:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    main()
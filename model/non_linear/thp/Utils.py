@@ -55,10 +55,11 @@ def compute_integral_unbiased(model, data, time, non_pad_mask, type_mask):
     return unbiased_integral
 
 
-def log_likelihood(model, data, time, types):
-    """ Log-likelihood of sequence. """
+def log_likelihood(model, data, time, types, non_pad_mask=None):
+    """ Log-likelihood of sequence; non_pad_mask (batch*seq_len) is derived from types if not given. """
 
-    non_pad_mask = get_non_pad_mask(types).squeeze(2)
+    if non_pad_mask is None:
+        non_pad_mask = get_non_pad_mask(types).squeeze(2)
 
     type_mask = torch.zeros([*types.size(), model.num_types], device=data.device)
     for i in range(model.num_types):
@@ -112,11 +113,12 @@ def time_loss(prediction, event_time):
     se = torch.sum(diff * diff)
     return se
 
-def log_likelihood_exo(model, data, time, types, endo_mask):
-    """ Log-likelihood of sequence. """
+def log_likelihood_exo(model, data, time, types, endo_mask, non_pad_mask=None):
+    """ Log-likelihood of sequence; non_pad_mask (batch*seq_len) is derived from types if not given. """
 
     exo_mask = torch.logical_not(endo_mask)
-    non_pad_mask = get_non_pad_mask(types).squeeze(2)
+    if non_pad_mask is None:
+        non_pad_mask = get_non_pad_mask(types).squeeze(2)
 
     type_mask = torch.zeros([*types.size(), model.num_types], device=data.device)
     for i in range(model.num_types):
@@ -173,6 +175,22 @@ def time_loss_exo(prediction, event_time, endo_mask):
     se = torch.sum(diff * diff)
     return se
 
+def time_loss_exo_ae(prediction, event_time, endo_mask):
+    """ Time prediction loss on endogenous events, plus the absolute error on all events as a metric. """
+
+    prediction.squeeze_(-1)
+
+    true = event_time[:, 1:] - event_time[:, :-1]
+    prediction = prediction[:, :-1]
+
+    # event time gap prediction, one pass over the difference for both errors
+    diff = prediction - true
+    endo_diff = diff[endo_mask[:, 1:]]
+    se = torch.sum(endo_diff * endo_diff)
+    with torch.no_grad():
+        ae = torch.sum(torch.abs(diff))
+    return se, ae
+
 def time_loss_ae(prediction, event_time):
     # absolute error
     prediction.squeeze_(-1)
@@ -185,6 +203,35 @@ def time_loss_ae(prediction, event_time):
     ae = torch.sum(diff)
     return ae
 
+def compute_loss(model, enc_out, prediction, event_time, event_type, pred_loss_func, non_pad_mask):
+    """ All training losses of one batch, kept in one function so it can be compiled as a single graph. """
+
+    # negative log-likelihood
+    event_ll, non_event_ll = log_likelihood(model, enc_out, event_time, event_type, non_pad_mask)
+    event_loss = -torch.sum(event_ll - non_event_ll)
+
+    # type prediction
+    pred_loss, pred_num_event = type_loss(prediction[0], event_type, pred_loss_func)
+
+    # time prediction
+    se = time_loss(prediction[1], event_time)
+    return event_loss, pred_loss, se, pred_num_event
+
+
+def compute_loss_exo(model, enc_out, prediction, event_time, event_type, pred_loss_func, endo_mask, non_pad_mask):
+    """ All training losses of one batch with exogenous events, plus the absolute time error. """
+
+    # negative log-likelihood
+    event_ll, non_event_ll = log_likelihood_exo(model, enc_out, event_time, event_type, endo_mask, non_pad_mask)
+    event_loss = -torch.sum(event_ll - non_event_ll)
+
+    # type prediction
+    pred_loss, pred_num_event = type_loss_exo(prediction[0], event_type, pred_loss_func, endo_mask)
+
+    # time prediction
+    se, ae = time_loss_exo_ae(prediction[1], event_time, endo_mask)
+    return event_loss, pred_loss, se, ae, pred_num_event
+
 class LabelSmoothingLoss(nn.Module):
     """
     With label smoothing,
@@ -1,5 +1,8 @@
+import math
 import numpy as np
+import os
 import torch
+import torch.distributed as dist
 import torch.utils.data
 
 from model.non_linear.thp.transformer import Constants
@@ -17,6 +20,7 @@ class EventData(torch.utils.data.Dataset):
         self.time_gap = [[elem['time_since_last_event'] for elem in inst] for inst in data]
         # plus 1 since there could be event type 0, but we use 0 as padding
         self.event_type = [[elem['type_event'] + 1 for elem in inst] for inst in data]
+        self.lengths = [len(inst) for inst in data]
 
         self.length = len(data)
 
@@ -41,6 +45,7 @@ class MaskedEventData(torch.utils.data.Dataset):
         # plus 1 since there could be event type 0, but we use 0 as padding
         self.event_type = [[elem['type_event'] + 1 for elem in inst] for inst in data]
         self.endo_mask = [[elem['endo_mask'] for elem in inst] for inst in data]
+        self.lengths = [len(inst) for inst in data]
 
         self.length = len(data)
 
@@ -52,39 +57,100 @@ class MaskedEventData(torch.utils.data.Dataset):
         return self.time[idx], self.time_gap[idx], self.event_type[idx], self.endo_mask[idx]
 
 
-def pad_time(insts):
-    """ Pad the instance to the max seq length in batch. """
+class MemmapEventData(torch.utils.data.Dataset):
+    """ Event stream dataset backed by memory-mapped arrays written by save_event_arrays. """
 
-    max_len = max(len(inst) for inst in insts)
+    def __init__(self, prefix):
+        """
+        prefix.offsets.npy indexes the concatenated prefix.time.npy, prefix.time_gap.npy and
+        prefix.event_type.npy; stream i is the slice offsets[i]:offsets[i + 1] of each array.
+        """
+        self.prefix = prefix
+        self.offsets = np.load(prefix + '.offsets.npy')
+        self.lengths = np.diff(self.offsets)
+        self.length = len(self.offsets) - 1
+        # opened lazily, so that each dataloader worker maps the files itself
+        self.arrays = None
 
-    batch_seq = np.array([
-        inst + [Constants.PAD] * (max_len - len(inst))
-        for inst in insts])
+    def __len__(self):
+        return self.length
 
-    return torch.tensor(batch_seq, dtype=torch.float32)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
 
+    def __getitem__(self, idx):
+        """ Each returned element is an array slice, which represents an event stream """
+        if self.arrays is None:
+            self.arrays = tuple(np.load(self.prefix + name, mmap_mode='r')
+                                for name in ('.time.npy', '.time_gap.npy', '.event_type.npy'))
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return tuple(arr[start:end] for arr in self.arrays)
 
-def pad_type(insts):
-    """ Pad the instance to the max seq length in batch. """
 
-    max_len = max(len(inst) for inst in insts)
+def source_fingerprint(path):
+    """ Modification time and size of the pickle the arrays are converted from. """
 
-    batch_seq = np.array([
-        inst + [Constants.PAD] * (max_len - len(inst))
-        for inst in insts])
+    stat = os.stat(path)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
 
-    return torch.tensor(batch_seq, dtype=torch.long)
 
+def event_arrays_current(prefix, source):
+    """ Whether the arrays under prefix exist and were converted from the current version of source. """
 
-def pad_endo_mask(insts):
+    if not os.path.exists(prefix + '.source.npy') or not os.path.exists(prefix + '.offsets.npy'):
+        return False
+    return np.array_equal(np.load(prefix + '.source.npy'), source_fingerprint(source))
+
+
+def save_event_arrays(data, num_types, prefix, source=None):
+    """ Flatten a list of event streams into the contiguous arrays read by MemmapEventData. """
+
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(inst) for inst in data], out=offsets[1:])
+
+    np.save(prefix + '.time.npy',
+            np.array([elem['time_since_start'] for inst in data for elem in inst], dtype=np.float32))
+    np.save(prefix + '.time_gap.npy',
+            np.array([elem['time_since_last_event'] for inst in data for elem in inst], dtype=np.float32))
+    # plus 1 since there could be event type 0, but we use 0 as padding
+    np.save(prefix + '.event_type.npy',
+            np.array([elem['type_event'] + 1 for inst in data for elem in inst], dtype=np.int64))
+    np.save(prefix + '.dim_process.npy', np.array(num_types, dtype=np.int64))
+    np.save(prefix + '.offsets.npy', offsets)
+    # written last, it marks a complete conversion of this version of the source pickle
+    if source is not None:
+        np.save(prefix + '.source.npy', source_fingerprint(source))
+
+
+def pad_batch(insts, dtype):
+    """ Pad the instance to the max seq length in batch, copying into one preallocated array. """
 
     max_len = max(len(inst) for inst in insts)
 
-    batch_seq = np.array([
-        inst + [Constants.PAD] * (max_len - len(inst))
-        for inst in insts])
+    batch_seq = np.full((len(insts), max_len), Constants.PAD, dtype=dtype)
+    for i, inst in enumerate(insts):
+        batch_seq[i, :len(inst)] = inst
+
+    return torch.from_numpy(batch_seq)
 
-    return torch.tensor(batch_seq, dtype=torch.bool)
+
+def pad_time(insts):
+    """ Pad the instance to the max seq length in batch. """
+
+    return pad_batch(insts, np.float32)
+
+
+def pad_type(insts):
+    """ Pad the instance to the max seq length in batch. """
+
+    return pad_batch(insts, np.int64)
+
+
+def pad_endo_mask(insts):
+
+    return pad_batch(insts, np.bool_)
 
 def collate_fn(insts):
     """ Collate function, as required by PyTorch. """
@@ -106,31 +172,163 @@ def masked_collate_fn(insts):
     return time, time_gap, event_type, endo_mask
 
 
-def get_dataloader(data, batch_size, shuffle=True):
+class DataPrefetcher:
+    """
+    Wrap a dataloader so that the host-to-device copy of the next batch runs
+    on a side CUDA stream while the current batch is being computed.
+    Batches are yielded already on the device; on CPU the copy is synchronous.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.iterator = None
+        self.next_batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        batch = self.next()
+        while batch is not None:
+            yield batch
+            batch = self.next()
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        if self.stream is None:
+            self.next_batch = tuple(x.to(self.device) for x in batch)
+            return
+
+        with torch.cuda.stream(self.stream):
+            self.next_batch = tuple(x.to(self.device, non_blocking=True) for x in batch)
+
+    def next(self):
+        batch = self.next_batch
+        if batch is None:
+            return None
+
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # the tensors were allocated on the side stream but are consumed on the current one
+            for x in batch:
+                x.record_stream(current_stream)
+        self.preload()
+        return batch
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch streams of similar length together to cut padding in the attention.
+    Shuffled indices are sorted by length within windows of `window` batches,
+    chunked into batches, and the batch order is shuffled again. When distributed,
+    every rank draws the same permutation (call set_epoch each epoch) and takes
+    every num_replicas-th batch. Like DistributedSampler, batches are repeated from
+    the start until every rank has the same, non-zero number of them.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, drop_last=False, window=100, distributed=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.window = window
+        self.num_replicas = dist.get_world_size() if distributed else 1
+        self.rank = dist.get_rank() if distributed else 0
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = len(self.lengths) // self.batch_size
+        else:
+            num_batches = math.ceil(len(self.lengths) / self.batch_size)
+        return math.ceil(num_batches / self.num_replicas)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        window_size = self.batch_size * self.window
+        for start in range(0, len(indices), window_size):
+            window = indices[start:start + window_size]
+            window = window[np.argsort(self.lengths[window], kind='stable')]
+            batches += [window[i:i + self.batch_size].tolist() for i in range(0, len(window), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        # same number of batches on every rank, so that the gradient AllReduce calls line up
+        total_size = len(self) * self.num_replicas
+        while batches and len(batches) < total_size:
+            batches += batches[:total_size - len(batches)]
+        return iter(batches[self.rank:total_size:self.num_replicas])
+
+
+def loader_workers(num_workers=None):
+    """ Worker settings shared by the dataloaders; persistent workers avoid re-forking every epoch. """
+
+    if num_workers is None:
+        num_workers = min(8, (os.cpu_count() or 2) // 2)
+    if num_workers == 0:
+        return {'num_workers': 0}
+    return {'num_workers': num_workers, 'persistent_workers': True, 'prefetch_factor': 4}
+
+
+def loader_sampling(ds, batch_size, shuffle, distributed=False, bucket=False, drop_last=False):
+    """ Batching arguments of the dataloader: plain, distributed, or length-bucketed. """
+
+    if bucket:
+        # the batch sampler also shards the batches across ranks
+        return {'batch_sampler': BucketBatchSampler(ds.lengths, batch_size, shuffle=shuffle, drop_last=drop_last,
+                                                    distributed=distributed)}
+    if distributed:
+        # each rank iterates over a disjoint shard; the sampler does the shuffling
+        return {'batch_size': batch_size, 'drop_last': drop_last,
+                'sampler': torch.utils.data.distributed.DistributedSampler(ds, shuffle=shuffle)}
+    return {'batch_size': batch_size, 'drop_last': drop_last, 'shuffle': shuffle}
+
+
+def get_dataloader(data, batch_size, shuffle=True, distributed=False, num_workers=None, bucket=False,
+                   drop_last=False):
     """ Prepare dataloader. """
 
-    ds = EventData(data)
+    ds = data if isinstance(data, torch.utils.data.Dataset) else EventData(data)
     dl = torch.utils.data.DataLoader(
         ds,
-        # num_workers=2,
-        num_workers=0,
-        batch_size=batch_size,
+        **loader_workers(num_workers),
+        **loader_sampling(ds, batch_size, shuffle, distributed=distributed, bucket=bucket, drop_last=drop_last),
         collate_fn=collate_fn,
-        shuffle=shuffle
+        # page-locked batches make the non_blocking copies of DataPrefetcher asynchronous
+        pin_memory=torch.cuda.is_available()
     )
     return dl
 
 
-def get_masked_dataloader(data, batch_size, shuffle=True):
-    """ Prepare dataloader. """
+def get_masked_dataloader(data, batch_size, shuffle=True, distributed=False, num_workers=None, bucket=False,
+                          drop_last=False):
+    """ Prepare dataloader; evaluation loaders for eval_epoch_mae must pass drop_last=True. """
 
     ds = MaskedEventData(data)
     dl = torch.utils.data.DataLoader(
         ds,
-        # num_workers=2,
-        num_workers=0,
-        batch_size=batch_size,
+        **loader_workers(num_workers),
+        **loader_sampling(ds, batch_size, shuffle, distributed=distributed, bucket=bucket, drop_last=drop_last),
         collate_fn=masked_collate_fn,
-        shuffle=shuffle
+        pin_memory=torch.cuda.is_available()
     )
     return dl
@@ -3,6 +3,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 import model.non_linear.thp.transformer.Constants as Constants
 from model.non_linear.thp.transformer.Layers import EncoderLayer
@@ -30,7 +31,7 @@ def get_subsequent_mask(seq):
 
     sz_b, len_s = seq.size()
     subsequent_mask = torch.triu(
-        torch.ones((len_s, len_s), device=seq.device, dtype=torch.uint8), diagonal=1)
+        torch.ones((len_s, len_s), device=seq.device, dtype=torch.bool), diagonal=1)
     subsequent_mask = subsequent_mask.unsqueeze(0).expand(sz_b, -1, -1)  # b x ls x ls
     return subsequent_mask
 
@@ -41,15 +42,19 @@ class Encoder(nn.Module):
     def __init__(
             self,
             num_types, d_model, d_inner,
-            n_layers, n_head, d_k, d_v, dropout):
+            n_layers, n_head, d_k, d_v, dropout, grad_checkpoint=False):
         super().__init__()
 
         self.d_model = d_model
 
-        # position vector, used for temporal encoding
-        self.position_vec = torch.tensor(
+        # recompute each layer's activations in backward instead of storing them
+        self.grad_checkpoint = grad_checkpoint
+
+        # position vector, used for temporal encoding; a buffer so that model.to(device) moves it,
+        # non-persistent so that state dicts are unchanged
+        self.register_buffer('position_vec', torch.tensor(
             [math.pow(10000.0, 2.0 * (i // 2) / d_model) for i in range(d_model)],
-            device=torch.device('cpu'))
+            device=torch.device('cpu')), persistent=False)
 
         # event type embedding
         self.event_emb = nn.Embedding(num_types + 1, d_model, padding_idx=Constants.PAD)
@@ -73,21 +78,26 @@ class Encoder(nn.Module):
         """ Encode event sequences via masked self-attention. """
 
         # prepare attention masks
-        # slf_attn_mask is where we cannot look, i.e., the future and the padding
+        # slf_attn_mask is where we may look, i.e., neither the future nor the padding
+        # both masks are broadcast views; the OR materializes a single contiguous b x ls x ls bool tensor,
+        # which is inverted in place and shared by all layers
         slf_attn_mask_subseq = get_subsequent_mask(event_type)
         slf_attn_mask_keypad = get_attn_key_pad_mask(seq_k=event_type, seq_q=event_type)
-        slf_attn_mask_keypad = slf_attn_mask_keypad.type_as(slf_attn_mask_subseq)
-        slf_attn_mask = (slf_attn_mask_keypad + slf_attn_mask_subseq).gt(0)
+        slf_attn_mask = (slf_attn_mask_keypad | slf_attn_mask_subseq).logical_not_()
 
         tem_enc = self.temporal_enc(event_time, non_pad_mask)
         enc_output = self.event_emb(event_type)
 
         for enc_layer in self.layer_stack:
             enc_output += tem_enc
-            enc_output, _ = enc_layer(
-                enc_output,
-                non_pad_mask=non_pad_mask,
-                slf_attn_mask=slf_attn_mask)
+            if self.grad_checkpoint and self.training:
+                enc_output, _ = checkpoint(
+                    enc_layer, enc_output, non_pad_mask, slf_attn_mask, use_reentrant=False)
+            else:
+                enc_output, _ = enc_layer(
+                    enc_output,
+                    non_pad_mask=non_pad_mask,
+                    slf_attn_mask=slf_attn_mask)
         return enc_output
 
 
@@ -135,7 +145,7 @@ class Transformer(nn.Module):
     def __init__(
             self,
             num_types, d_model=256, d_rnn=128, d_inner=1024,
-            n_layers=4, n_head=4, d_k=64, d_v=64, dropout=0.1):
+            n_layers=4, n_head=4, d_k=64, d_v=64, dropout=0.1, grad_checkpoint=False):
         super().__init__()
 
         self.encoder = Encoder(
@@ -147,6 +157,7 @@ class Transformer(nn.Module):
             d_k=d_k,
             d_v=d_v,
             dropout=dropout,
+            grad_checkpoint=grad_checkpoint,
         )
 
         self.num_types = num_types
@@ -169,18 +180,20 @@ class Transformer(nn.Module):
         # prediction of next event type
         self.type_predictor = Predictor(d_model, num_types)
 
-    def forward(self, event_type, event_time):
+    def forward(self, event_type, event_time, non_pad_mask=None):
         """
         Return the hidden representations and predictions.
         For a sequence (l_1, l_2, ..., l_N), we predict_rmtpp (l_2, ..., l_N, l_{N+1}).
         Input: event_type: batch*seq_len;
-               event_time: batch*seq_len.
+               event_time: batch*seq_len;
+               non_pad_mask: batch*seq_len*1, derived from event_type if not given.
         Output: enc_output: batch*seq_len*model_dim;
                 type_prediction: batch*seq_len*num_classes (not normalized);
                 time_prediction: batch*seq_len.
         """
 
-        non_pad_mask = get_non_pad_mask(event_type)
+        if non_pad_mask is None:
+            non_pad_mask = get_non_pad_mask(event_type)
 
         enc_output = self.encoder(event_type, event_time, non_pad_mask)
         enc_output = self.rnn(enc_output, non_pad_mask)
@@ -2,6 +2,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+# F.scaled_dot_product_attention accepts an explicit scale from torch 2.1 on
+SDPA_WITH_SCALE = tuple(int(x) for x in torch.__version__.split('.')[:2]) >= (2, 1)
+
 
 class ScaledDotProductAttention(nn.Module):
     """ Scaled Dot-Product Attention """
@@ -13,10 +16,19 @@ class ScaledDotProductAttention(nn.Module):
         self.dropout = nn.Dropout(attn_dropout)
 
     def forward(self, q, k, v, mask=None):
+        if SDPA_WITH_SCALE:
+            # with a dense boolean mask SDPA runs the memory-efficient (or math) kernel, not FlashAttention;
+            # the attention weights are not returned.
+            # mask is True where we may attend, as SDPA's attn_mask expects
+            output = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=mask,
+                dropout_p=self.dropout.p if self.training else 0.0, scale=1.0 / self.temperature)
+            return output, None
+
         attn = torch.matmul(q / self.temperature, k.transpose(2, 3))
 
         if mask is not None:
-            attn = attn.masked_fill(mask, -1e9)
+            attn = attn.masked_fill(mask.logical_not(), -1e9)
 
         attn = self.dropout(F.softmax(attn, dim=-1))
         output = torch.matmul(attn, v)
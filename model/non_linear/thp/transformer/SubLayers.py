@@ -48,6 +48,8 @@ class MultiHeadAttention(nn.Module):
         v = self.w_vs(v).view(sz_b, len_v, n_head, d_v)
 
         # Transpose for attention dot product: b x n x lq x dv
+        # The views keep a unit stride on the last dim, the layout the fused SDPA kernels read
+        # directly, so no .contiguous() copy is made here.
         q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
 
         if mask is not None: